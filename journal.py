@@ -0,0 +1,155 @@
+# WRITE JOURNAL
+#
+# Patches are appended to a JSONL journal and sent to the server later by flush_journal().
+# Every read-modify-write of the journal happens under an exclusive lock on <journal>.lock,
+# so a flush in one terminal can't erase a patch queued from another.
+# Patches the server refuses as invalid are moved to <journal>.rejected.
+
+import fcntl
+import json
+import os
+from contextlib import contextmanager
+
+@contextmanager
+def journal_lock(path):
+    '''Holds an exclusive lock on the journal for the duration of the with block. Takes the journal path'''
+    with open(path + ".lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def read_journal(path):
+    '''Reads all queued patches from a journal file. Takes the journal path and returns a list of entry dictionaries'''
+    if not os.path.exists(path):
+        return []
+
+    entries = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            # A half-written last line means we crashed mid-append, so skip it
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                continue
+    return entries
+
+def write_journal(path, entries):
+    '''Replaces a journal with the given entries. Writes to a temp file first so a crash can't leave it half-written. Callers must hold the journal lock'''
+    if not entries:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        for entry in entries:
+            f.write(json.dumps(entry) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def append_journal(path, entry):
+    '''Appends a single patch to a journal and syncs it to disk. Takes the journal path and the entry'''
+    with journal_lock(path):
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+def reject_journal_entries(path, entries, error):
+    '''Appends patches the server refused to the rejected file next to a journal. Takes the journal path, the entries and the error message'''
+    with open(path + ".rejected", "a", encoding="utf-8") as f:
+        for entry in entries:
+            rejected = dict(entry)
+            rejected["error"] = error
+            f.write(json.dumps(rejected) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+def requeue_rejected(path):
+    '''Moves every rejected patch back into the journal so the next flush tries it again. Takes the journal path and returns the number of entries moved'''
+    rejected_path = path + ".rejected"
+
+    with journal_lock(path):
+        rejected = read_journal(rejected_path)
+        if not rejected:
+            return 0
+
+        for entry in rejected:
+            entry.pop("error", None)
+        write_journal(path, read_journal(path) + rejected)
+        os.remove(rejected_path)
+
+    return len(rejected)
+
+def coalesce_journal(entries):
+    '''Merges queued patches so each record is only patched once. Later edits to the same field win. Returns a dict of table key to a list of payloads'''
+    batches = {}
+    patches = {}
+
+    for entry in entries:
+        # Merge into the pending patch for this record, keeping first-seen order
+        record_key = (entry["table"], entry["id"])
+        if record_key not in patches:
+            patches[record_key] = {"Id": entry["id"]}
+            batches.setdefault(entry["table"], []).append(patches[record_key])
+        patches[record_key].update(entry["payload"])
+
+    return batches
+
+def flush_journal(path, send_batch, on_flushed=None):
+    '''Sends all queued patches, one batch per table. Takes the journal path, a send_batch(table_key, payloads) function and an optional on_flushed(table_key, response, payloads) callback.
+
+    send_batch must raise RuntimeError for failures worth retrying later and ValueError when the server rejects the patch as invalid.
+    Entries are only removed from the journal once their batch is sent or rejected. Returns the number of records written'''
+    written = 0
+    rejected = 0
+
+    with journal_lock(path):
+        entries = read_journal(path)
+        if not entries:
+            return 0
+
+        for table_key, payloads in coalesce_journal(entries).items():
+            try:
+                response = send_batch(table_key, payloads)
+                sent = payloads
+            except RuntimeError as e:
+                print(f"Could not flush {len(payloads)} queued patch(es) to {table_key}: {e}")
+                continue
+            except ValueError:
+                # One bad field fails the whole batch, so send them one at a time to find it
+                response = None
+                sent = []
+                for payload in payloads:
+                    try:
+                        send_batch(table_key, [payload])
+                        sent.append(payload)
+                    except RuntimeError as e:
+                        print(f"Could not flush patch for record {payload['Id']} in {table_key}: {e}")
+                    except ValueError as e:
+                        bad_entries = [entry for entry in entries if (entry["table"], entry["id"]) == (table_key, payload["Id"])]
+                        reject_journal_entries(path, bad_entries, str(e))
+                        entries = [entry for entry in entries if entry not in bad_entries]
+                        write_journal(path, entries)
+                        rejected += 1
+                        print(f"Server rejected patch for record {payload['Id']} in {table_key}: {e}")
+
+            written += len(sent)
+
+            # Drop the flushed entries straight away. Patches are safe to resend, so a
+            # crash before this point just repeats them on the next flush
+            sent_keys = {(table_key, p["Id"]) for p in sent}
+            entries = [e for e in entries if (e["table"], e["id"]) not in sent_keys]
+            write_journal(path, entries)
+
+            if on_flushed and sent:
+                on_flushed(table_key, response, sent)
+
+    if rejected:
+        print(f"{rejected} rejected patch(es) moved to {path}.rejected. Run 'requeue-rejected' to try them again.")
+    if entries:
+        print(f"{len(entries)} queued patches kept in {path}. Run 'flush' to retry.")
+    return written
@@ -5,7 +5,11 @@ import requests
 import argparse
 from dotenv import load_dotenv
 import os
+import json
+import time
 from formatters import *
+from journal import append_journal, flush_journal, read_journal, requeue_rejected
+from snapshot import open_snapshot, write_snapshot, snapshot_records, snapshot_column
 
 load_dotenv()
 
@@ -21,6 +25,34 @@ subparsers = parser.add_subparsers(dest="command", required=True)
 API_KEY = os.getenv("API_KEY")
 BASE_ID = os.getenv("BASE_ID")
 
+# Local write journal. Queued patches live here until they are flushed
+JOURNAL_PATH = os.getenv("JOURNAL_PATH", "library_journal.jsonl")
+
+# Saved queries and their materialised result Ids
+SAVED_QUERIES_PATH = os.getenv("SAVED_QUERIES_PATH", "saved_queries.json")
+
+# Max number of Ids looked up in one request
+ID_LOOKUP_CHUNK = 100
+
+# Page size used when streaming whole tables for export
+EXPORT_PAGE_SIZE = 100
+
+# Snapshot opened with --snapshot. Read commands are served from it instead of the API
+active_snapshot = None
+
+# Seconds to wait for the server before giving up on a request
+REQUEST_TIMEOUT = 10
+
+# Flush retry settings for the 'flush' command. Delay doubles after each failed attempt
+FLUSH_RETRIES = 3
+FLUSH_RETRY_DELAY = 1.0
+
+# HTTP statuses that mean the patch itself is invalid. Any other failure keeps it queued
+REJECTED_STATUSES = {400, 422}
+
+# HTTP statuses worth retrying straight away
+RETRY_STATUSES = {408, 429}
+
 # HTTP headers. Asks for JSON to be returned and does the auth
 headers = {
     "accept": "application/json",
@@ -61,16 +93,29 @@ FORMATTERS = {
 
 # UTILITY FUNCTIONS
 
+def read_snapshot(reader, *reader_args):
+    '''Reads from the active snapshot with the given snapshot function. Exits with a message if the table wasn't exported'''
+    try:
+        return reader(active_snapshot, *reader_args)
+    except ValueError as e:
+        print(f"Error: {e}")
+        print("Export the table again or run without --snapshot.")
+        raise SystemExit(1)
+
 def get_records(table_id_arg):
     '''Sends a GET request to the API. Takes a table ID as an argument and returns the record data or an error message'''
 
     table_id = table_id_arg
 
+    # Serve from the snapshot if one is open
+    if active_snapshot:
+        return read_snapshot(snapshot_records, table_id)
+
     # API GET URL
     url = f"http://127.0.0.1:8080/api/v2/tables/{table_id}/records"
     
     # Sends the GET request
-    response = requests.get(url, headers=headers)
+    response = requests.get(url, headers=headers, timeout=REQUEST_TIMEOUT)
 
     # If the request succeeds (HTTP status 200), return list of records
     if response.status_code == 200:
@@ -81,22 +126,51 @@ def get_records(table_id_arg):
         print("Error:", response.status_code, response.text)
         return []
 
-def patch_record(table_key, record_id, payload):
-    '''Sends a PATCH request to the API. Takes table key, and payload as inputs'''
-    table_id = TABLE_IDS[table_key.upper()]
-    url = f"http://127.0.0.1:8080/api/v2/tables/{table_id}/records"
+def get_records_by_id(table_id_arg, record_ids):
+    '''Sends GET requests for specific records only. Takes a table ID and a list of record IDs and returns the matching record data. Raises RuntimeError if a lookup fails'''
+    if active_snapshot:
+        wanted = set(record_ids)
+        return [r for r in read_snapshot(snapshot_records, table_id_arg) if r.get("Id") in wanted]
 
-    # Insert ID into the payload
-    payload_with_id = {"Id": record_id}
-    payload_with_id.update(payload)
+    url = f"http://127.0.0.1:8080/api/v2/tables/{table_id_arg}/records"
+    records = []
 
-    response = requests.patch(url, headers=headers, json=payload_with_id)
+    # Look the Ids up in chunks to keep the where clause a sensible length
+    for i in range(0, len(record_ids), ID_LOOKUP_CHUNK):
+        chunk = record_ids[i:i + ID_LOOKUP_CHUNK]
+        where = "~or".join(f"(Id,eq,{record_id})" for record_id in chunk)
+        params = {"where": where, "limit": len(chunk)}
 
-    if response.status_code == 200:
-        debug_print(f"Record {record_id} updated successfully.")
-        return response.json()
-    else:
-        raise RuntimeError(f"PATCH failed: {response.status_code} - {response.text}")
+        response = requests.get(url, headers=headers, params=params, timeout=REQUEST_TIMEOUT)
+
+        if response.status_code != 200:
+            raise RuntimeError(f"GET failed: {response.status_code} - {response.text}")
+
+        records.extend(response.json()["list"])
+
+    return records
+
+def get_records_paged(table_id_arg, page_size=EXPORT_PAGE_SIZE):
+    '''Sends paged GET requests for a whole table. Takes a table ID and page size and yields one list of records per page. Raises RuntimeError if a page fails'''
+    url = f"http://127.0.0.1:8080/api/v2/tables/{table_id_arg}/records"
+    offset = 0
+
+    while True:
+        # Sort by Id so pages don't shift between requests
+        params = {"limit": page_size, "offset": offset, "sort": "Id"}
+        response = requests.get(url, headers=headers, params=params, timeout=REQUEST_TIMEOUT)
+
+        if response.status_code != 200:
+            raise RuntimeError(f"GET failed: {response.status_code} - {response.text}")
+
+        data = response.json()
+        page = data["list"]
+        debug_print(f"Fetched {len(page)} records from offset {offset}")
+        yield page
+
+        offset += len(page)
+        if not page or data.get("pageInfo", {}).get("isLastPage", True):
+            break
 
 def post_record(table_key, payload):
     '''Sends a POST request to create a new record in a table. Takes table key and payload as inputs'''
@@ -111,6 +185,38 @@ def post_record(table_key, payload):
     else:
         raise RuntimeError(f"POST failed: {response.status_code} - {response.text}")
 
+def send_patch_batch(table_key, payloads, attempts=FLUSH_RETRIES):
+    '''Sends a list of record updates to the API in a single bulk PATCH. Takes table key, payload list and number of attempts. Retries on connection errors, timeouts, rate limits and server errors and raises RuntimeError if it still fails. Raises ValueError if the server rejects the patch as invalid'''
+    table_id = TABLE_IDS[table_key.upper()]
+    url = f"http://127.0.0.1:8080/api/v2/tables/{table_id}/records"
+    delay = FLUSH_RETRY_DELAY
+
+    for attempt in range(1, attempts + 1):
+        # Only patches go through here. Setting the same values twice is harmless, so retrying is safe
+        try:
+            response = requests.patch(url, headers=headers, json=payloads, timeout=REQUEST_TIMEOUT)
+        except requests.exceptions.RequestException as e:
+            error = f"PATCH failed: {e}"
+        else:
+            if response.status_code == 200:
+                return response.json()
+            error = f"PATCH failed: {response.status_code} - {response.text}"
+
+            # A bad field or value won't fix itself
+            if response.status_code in REJECTED_STATUSES:
+                raise ValueError(error)
+
+            # Auth and lookup errors need a config fix, not a retry, but the patch stays queued
+            if response.status_code < 500 and response.status_code not in RETRY_STATUSES:
+                raise RuntimeError(error)
+
+        debug_print(f"Attempt {attempt}/{attempts}: {error}")
+        if attempt < attempts:
+            time.sleep(delay)
+            delay *= 2
+
+    raise RuntimeError(error)
+
 def print_valid_tables():
     '''Prints a list of all valid tables'''
     print("Available tables: ")
@@ -130,11 +236,14 @@ def infer_field_type(table_key, field_name, override_type=None):
     if override_type:
         return override_type
 
-    records = get_records(TABLE_IDS[table_key.upper()])
+    # A snapshot can hand over just the one column
+    if active_snapshot:
+        values = read_snapshot(snapshot_column, TABLE_IDS[table_key.upper()], field_name)
+    else:
+        values = [record.get(field_name) for record in get_records(TABLE_IDS[table_key.upper()])]
     seen_values = set()
 
-    for record in records:
-        value = record.get(field_name)
+    for value in values:
 
         if value is None or value == "":
             continue
@@ -201,6 +310,30 @@ def debug_print(*args, **kwargs):
     if args_global.verbose:
         print("[DEBUG]", *args, **kwargs)
 
+# WRITE JOURNAL
+
+def queue_patch(table_key, record_id, payload):
+    '''Queues a PATCH in the local journal instead of sending it straight away. Takes table key, record ID and payload'''
+    append_journal(JOURNAL_PATH, {"op": "patch", "table": table_key.upper(), "id": record_id, "payload": payload})
+    debug_print(f"Queued patch for record {record_id}: {payload}")
+
+def update_flushed_records(table_key, response, payloads):
+    '''Lets saved queries pick up records that were just flushed. Takes table key, the API response and the sent payloads'''
+    if isinstance(response, list):
+        changed_ids = [r["Id"] for r in response if isinstance(r, dict) and "Id" in r]
+    else:
+        changed_ids = [p["Id"] for p in payloads]
+
+    # The patches are already sent, so a failure here must not stop the flush
+    try:
+        update_saved_queries(table_key, changed_ids)
+    except (RuntimeError, ValueError, OSError, requests.exceptions.RequestException) as e:
+        print(f"Saved queries on {table_key} not updated: {e}. Run 'refresh-query' to catch up.")
+
+def flush_queued_patches(attempts=FLUSH_RETRIES):
+    '''Flushes the journal. Takes the number of attempts per batch and returns the number of records written'''
+    return flush_journal(JOURNAL_PATH, lambda table_key, payloads: send_patch_batch(table_key, payloads, attempts), update_flushed_records)
+
 # CORE FEATURES
 
 def find_empty_fields(table_key, field_name, formatter):
@@ -307,6 +440,8 @@ def list_book_editions(book_title):
 
 def parse_filter_criteria(criteria_list):
     '''Takes filter arguments and formats them for usage. Takes arguments and returns a list of dictionaries'''
+    parsed_filters = []
+
     for criterion in criteria_list:
 
         # Initialise empty dict
@@ -317,8 +452,6 @@ def parse_filter_criteria(criteria_list):
                 "negate": False,
         }
 
-        parsed_filters = []
-
         # Check for logic prefixes
         if criterion.upper().startswith("NOT:"):
             parsed_filter["negate"] = True
@@ -455,13 +588,9 @@ def filter_and_patch(table_key, search_criteria, patch_field, patch_content):
         print("Cancelled.")
         return
 
-    # Patch it
-    success = patch_record(table_key, record_id, {valid_field: patch_content})
-
-    if success:
-        print("Record successfully updated.")
-    else:
-        print("Patch failed.")
+    # Queue it. It gets sent when the journal is flushed
+    queue_patch(table_key, record_id, {valid_field: patch_content})
+    print("Patch queued.")
 
 # Concatenation functions
 def generate_display_name(record):
@@ -471,6 +600,61 @@ def generate_display_name(record):
     title = record.get("Title", "Untitled")
     return f"{author} - {year} - {title}"
 
+# SAVED QUERIES
+
+def load_saved_queries():
+    '''Loads saved queries from disk. Returns a dict of query name to query data. Raises ValueError if the file is damaged'''
+    if not os.path.exists(SAVED_QUERIES_PATH):
+        return {}
+
+    with open(SAVED_QUERIES_PATH, "r", encoding="utf-8") as f:
+        try:
+            return json.load(f)
+        except ValueError as e:
+            raise ValueError(f"{SAVED_QUERIES_PATH} is damaged ({e}). Fix or delete it to use saved queries.")
+
+def write_saved_queries(queries):
+    '''Writes saved queries to disk. Writes to a temp file first so a crash can't leave it half-written'''
+    tmp_path = SAVED_QUERIES_PATH + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(queries, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, SAVED_QUERIES_PATH)
+
+def materialise_query(table_key, criteria_list):
+    '''Runs a filter over the full table. Takes table key and criteria list and returns a sorted list of matching record IDs. Raises RuntimeError if a page fails'''
+    parsed_criteria = parse_filter_criteria(criteria_list)
+    ids = []
+
+    # Paged fetch raises on errors, so a failed request can't look like an empty table
+    for page in get_records_paged(TABLE_IDS[table_key.upper()]):
+        ids.extend(r["Id"] for r in page if record_matches_filter(r, parsed_criteria))
+    return sorted(ids)
+
+def update_saved_queries(table_key, record_ids):
+    '''Updates the stored results of every saved query on a table for a set of changed records. Takes table key and list of changed record IDs'''
+    queries = load_saved_queries()
+    table_queries = {name: q for name, q in queries.items() if q["table"] == table_key.upper()}
+    if not table_queries or not record_ids:
+        return
+
+    # Only the changed records are fetched, never the whole table
+    records = get_records_by_id(TABLE_IDS[table_key.upper()], record_ids)
+
+    for name, query in table_queries.items():
+        parsed_criteria = parse_filter_criteria(query["criteria"])
+        ids = set(query["ids"])
+        for record in records:
+            if record_matches_filter(record, parsed_criteria):
+                ids.add(record["Id"])
+            else:
+                ids.discard(record["Id"])
+        query["ids"] = sorted(ids)
+        debug_print(f"Saved query '{name}' now has {len(ids)} records")
+
+    write_saved_queries(queries)
+
 # HANDLER FUNCTIONS FOR CLEAN CLI LOGIC
 
 def handle_get(table_key):
@@ -555,6 +739,133 @@ def handle_filter_and_patch(table_key, criteria, field, new_value):
         filter_and_patch(table_key, criteria, field, new_value)
     except ValueError as e:
         print(f"Error: {e}")
+    except requests.exceptions.RequestException as e:
+        print(f"Could not reach the server to find records: {e}")
+        print("Use 'patch-id' to queue an edit by record ID while the server is down.")
+
+def handle_patch_by_id(table_key, record_id, field, new_value):
+    '''Handles queueing a patch for a known record ID. Needs no server access, so the field name is sent exactly as typed'''
+    queue_patch(table_key, record_id, {field: new_value})
+    print(f"Patch for record {record_id} queued.")
+
+def handle_save_query(name, table_key, criteria_list):
+    '''Handles saving a named query. Takes a name, table key and criteria list, materialises the results and stores them'''
+    parsed_filter_criteria = parse_filter_criteria(criteria_list)
+    validate_fields([f["field"] for f in parsed_filter_criteria], table_key)
+
+    queries = load_saved_queries()
+    ids = materialise_query(table_key, criteria_list)
+    queries[name] = {"table": table_key.upper(), "criteria": criteria_list, "ids": ids}
+    write_saved_queries(queries)
+    print(f"Saved query '{name}' with {len(ids)} matching records.")
+
+def handle_run_query(name):
+    '''Handles running a saved query. Takes a query name and prints its formatted records'''
+    queries = load_saved_queries()
+    query = queries.get(name)
+    if not query:
+        print(f"No saved query named '{name}'.")
+        return
+
+    try:
+        records = get_records_by_id(TABLE_IDS[query["table"]], query["ids"])
+    except (RuntimeError, requests.exceptions.RequestException) as e:
+        print(f"Could not fetch records for '{name}': {e}")
+        return
+
+    # Drop any records that were edited elsewhere and no longer match
+    parsed_criteria = parse_filter_criteria(query["criteria"])
+    matches = [r for r in records if record_matches_filter(r, parsed_criteria)]
+    match_ids = sorted(r["Id"] for r in matches)
+    # Snapshot data may be out of date, so only prune against the live server
+    if match_ids != query["ids"] and not active_snapshot:
+        debug_print(f"Pruned {len(query['ids']) - len(match_ids)} stale records from '{name}'")
+        query["ids"] = match_ids
+        write_saved_queries(queries)
+
+    formatter = FORMATTERS[query["table"]]
+    for record in sorted(matches, key=lambda r: r["Id"]):
+        formatter(record)
+
+    if not matches:
+        print("No matching records found.")
+
+def handle_list_queries():
+    '''Handles listing saved queries. Prints each query with its table, criteria and result count'''
+    queries = load_saved_queries()
+    if not queries:
+        print("No saved queries.")
+        return
+
+    for name, query in queries.items():
+        print(f"{name} ({query['table']}): {' '.join(query['criteria'])} - {len(query['ids'])} records")
+
+def handle_delete_query(name):
+    '''Handles deleting a saved query. Takes a query name'''
+    queries = load_saved_queries()
+    if queries.pop(name, None) is None:
+        print(f"No saved query named '{name}'.")
+        return
+
+    write_saved_queries(queries)
+    print(f"Deleted saved query '{name}'.")
+
+def handle_refresh_queries(name=None):
+    '''Handles recomputing saved query results from scratch. Picks up edits made outside this tool. Takes an optional query name, otherwise refreshes them all'''
+    queries = load_saved_queries()
+    if name and name not in queries:
+        print(f"No saved query named '{name}'.")
+        return
+
+    for query_name, query in queries.items():
+        if name and query_name != name:
+            continue
+        # Leave the stored Ids alone if the table can't be read
+        try:
+            query["ids"] = materialise_query(query["table"], query["criteria"])
+        except (RuntimeError, requests.exceptions.RequestException) as e:
+            print(f"Could not refresh '{query_name}': {e}")
+            continue
+        print(f"Refreshed '{query_name}': {len(query['ids'])} records.")
+
+    write_saved_queries(queries)
+
+def handle_export(path, table_keys):
+    '''Handles exporting tables to a snapshot file. Takes an output path and a list of table keys and streams each table into the file'''
+    tables = ((key.upper(), TABLE_IDS[key.upper()], get_records_paged(TABLE_IDS[key.upper()])) for key in table_keys)
+
+    # Write to a temp file so a failed export doesn't clobber an older snapshot
+    tmp_path = path + ".tmp"
+    try:
+        counts = write_snapshot(tmp_path, tables)
+    except (RuntimeError, requests.exceptions.RequestException) as e:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        print(f"Export failed: {e}")
+        return
+    os.replace(tmp_path, path)
+
+    for table_key, count in counts.items():
+        print(f"{table_key}: {count} records")
+    print(f"Snapshot written to {path}")
+
+def handle_flush():
+    '''Handles the logic for the flush_journal() function. Prints how many queued records were written'''
+    if not read_journal(JOURNAL_PATH):
+        print("Nothing to flush.")
+        return
+
+    written = flush_queued_patches()
+    print(f"Flushed {written} record(s).")
+
+def handle_requeue_rejected():
+    '''Handles moving rejected patches back into the journal. Prints how many were requeued'''
+    count = requeue_rejected(JOURNAL_PATH)
+    if not count:
+        print("No rejected patches.")
+        return
+
+    print(f"Requeued {count} rejected patch(es). Run 'flush' to send them.")
 
 # DEBUG HANDLERS
 def handle_debug_type(table_key, field):
@@ -587,6 +898,36 @@ patch_parser.add_argument("criteria", help="Search criteria (e.g., genre=fiction
 patch_parser.add_argument("field", help="Field to patch (e.g., title)")
 patch_parser.add_argument("new_value", help="New value to patch into the matched record")
 
+save_query_parser = subparsers.add_parser("save-query", help="Save a named filter and store its results locally")
+save_query_parser.add_argument("name", help="Name of the saved query")
+save_query_parser.add_argument("table", choices=[t.lower() for t in TABLE_IDS.keys()], type=str.lower, help="Table to filter")
+save_query_parser.add_argument("criteria", nargs="+", help="List of filters, e.g. Status=unread Owned=true")
+
+run_query_parser = subparsers.add_parser("run-query", help="Print the records in a saved query")
+run_query_parser.add_argument("name", help="Name of the saved query")
+
+list_queries_parser = subparsers.add_parser("list-queries", help="List all saved queries")
+
+delete_query_parser = subparsers.add_parser("delete-query", help="Delete a saved query")
+delete_query_parser.add_argument("name", help="Name of the saved query")
+
+refresh_query_parser = subparsers.add_parser("refresh-query", help="Recompute saved query results from the full table")
+refresh_query_parser.add_argument("name", nargs="?", help="Name of the saved query. Refreshes all of them if left out")
+
+patch_id_parser = subparsers.add_parser("patch-id", help="Queue a patch for a record by ID. Works while the server is down")
+patch_id_parser.add_argument("table", choices=[t.lower() for t in TABLE_IDS.keys()], type=str.lower, help="Table the record is in")
+patch_id_parser.add_argument("id", type=int, help="Record ID")
+patch_id_parser.add_argument("field", help="Field to patch, exactly as named in the table (e.g. Title)")
+patch_id_parser.add_argument("new_value", help="New value to patch into the record")
+
+flush_parser = subparsers.add_parser("flush", help="Send all queued patches to the server")
+requeue_parser = subparsers.add_parser("requeue-rejected", help="Move patches the server rejected back into the queue")
+export_parser = subparsers.add_parser("export", help="Dump tables to a snapshot file that can be used with --snapshot")
+export_parser.add_argument("path", help="Snapshot file to write")
+export_parser.add_argument("--tables", nargs="+", choices=[t.lower() for t in TABLE_IDS.keys()], type=str.lower, default=[t.lower() for t in TABLE_IDS.keys()], help="Tables to export")
+
+parser.add_argument("--snapshot", help="Serve read commands from a snapshot file instead of the server")
+parser.add_argument("--no-flush", action="store_true", help="Keep queued patches in the local journal instead of sending them when the command finishes")
 
 # DEBUGGING ARGPARSE LOGIC
 fields_parser = subparsers.add_parser("debug-fields", help="Print all field names in a table")
@@ -605,6 +946,17 @@ type_parser.add_argument("--override-type", help="Manually override the inferred
 args = parser.parse_args()
 args_global = args
 
+# Commands that change the server or saved queries can't run against a snapshot
+if args.snapshot:
+    if args.command in ("patch", "patch-id", "flush", "requeue-rejected", "export", "save-query", "refresh-query", "delete-query"):
+        print(f"'{args.command}' changes live data and can't be used with --snapshot.")
+        raise SystemExit(1)
+    try:
+        active_snapshot = open_snapshot(args.snapshot)
+    except (OSError, ValueError) as e:
+        print(f"Could not open snapshot: {e}")
+        raise SystemExit(1)
+
 # PARSE AND CALL
 if args.command == "get":
     handle_get(args.table)
@@ -624,6 +976,50 @@ elif args.command == "list-editions":
 elif args.command == "patch":
     handle_filter_and_patch(args.table, [args.criteria], args.field, args.new_value)
 
+elif args.command == "patch-id":
+    handle_patch_by_id(args.table, args.id, args.field, args.new_value)
+
+elif args.command == "save-query":
+    try:
+        handle_save_query(args.name, args.table, args.criteria)
+    except ValueError as e:
+        print(f"Error: {e}")
+    except (RuntimeError, requests.exceptions.RequestException) as e:
+        print(f"Could not save query: {e}")
+
+elif args.command == "run-query":
+    try:
+        handle_run_query(args.name)
+    except ValueError as e:
+        print(f"Error: {e}")
+
+elif args.command == "list-queries":
+    try:
+        handle_list_queries()
+    except ValueError as e:
+        print(f"Error: {e}")
+
+elif args.command == "delete-query":
+    try:
+        handle_delete_query(args.name)
+    except ValueError as e:
+        print(f"Error: {e}")
+
+elif args.command == "refresh-query":
+    try:
+        handle_refresh_queries(args.name)
+    except ValueError as e:
+        print(f"Error: {e}")
+
+elif args.command == "export":
+    handle_export(args.path, args.tables)
+
+elif args.command == "flush":
+    handle_flush()
+
+elif args.command == "requeue-rejected":
+    handle_requeue_rejected()
+
 
 # DEBUGGING PARSE AND CALL
 elif args.command == "debug-fields":
@@ -644,3 +1040,6 @@ elif args.command == "debug-type":
     except ValueError as e:
         print(f"Error: {e}")
 
+# Commands that queued a patch try one quick flush. Retries are left to the 'flush' command
+if args.command in ("patch", "patch-id") and not args.no_flush and not args.snapshot and read_journal(JOURNAL_PATH):
+    flush_queued_patches(attempts=1)
@@ -0,0 +1,161 @@
+# SNAPSHOT FILES
+#
+# Snapshots are full table dumps in a small columnar format that can be opened with mmap.
+# Nothing is read into memory up front. Values are only decoded when a record or column is asked for.
+#
+# File layout (all integers little-endian):
+#
+#   b"LIBSNAP1"                      8 byte magic
+#   column chunk, column chunk, ...  one chunk per column per row group, each 8-byte aligned
+#   directory                        UTF-8 JSON, see below
+#   uint64                           length of the directory in bytes
+#   b"LIBSNAP1"                      8 byte magic
+#
+# A column chunk for a row group of n rows is n + 1 uint32 offsets followed by the value data.
+# Value i is the bytes from offsets[i] to offsets[i + 1], counted from the end of the offsets.
+# Each value is UTF-8 JSON. A zero-length value means the record didn't have that field at all.
+#
+# The directory looks like:
+#
+#   {"version": 1,
+#    "tables": {"BOOKS": {"table_id": "...",
+#                         "columns": ["Id", "Title", ...],
+#                         "row_groups": [{"rows": 25, "chunks": {"Id": 8, "Title": 120, ...}}]}}}
+#
+# Each fetched page becomes one row group, so tables can be written as they stream in.
+
+import json
+import mmap
+import struct
+
+MAGIC = b"LIBSNAP1"
+VERSION = 1
+
+# Marker for fields that weren't in a record, as opposed to fields that were null
+MISSING = object()
+
+def write_column_chunk(f, values):
+    '''Writes one column chunk at the current (aligned) file position. Takes an open file and a list of encoded values. Returns the chunk offset'''
+    # Pad so the offsets array is always aligned
+    f.write(b"\0" * (-f.tell() % 8))
+    chunk_offset = f.tell()
+
+    offsets = [0]
+    for value in values:
+        offsets.append(offsets[-1] + len(value))
+    f.write(struct.pack(f"<{len(offsets)}I", *offsets))
+    f.write(b"".join(values))
+
+    return chunk_offset
+
+def write_snapshot(path, tables):
+    '''Writes a snapshot file. Takes a path and an iterable of (table key, table ID, pages) where pages is an iterable of record lists. Returns the number of records written per table'''
+    directory = {"version": VERSION, "tables": {}}
+    counts = {}
+
+    with open(path, "wb") as f:
+        f.write(MAGIC)
+
+        for table_key, table_id, pages in tables:
+            table_entry = {"table_id": table_id, "columns": [], "row_groups": []}
+            counts[table_key] = 0
+
+            for page in pages:
+                if not page:
+                    continue
+
+                # Keep the field order as it comes back from the API
+                for record in page:
+                    for column in record:
+                        if column not in table_entry["columns"]:
+                            table_entry["columns"].append(column)
+
+                chunks = {}
+                for column in table_entry["columns"]:
+                    values = [json.dumps(r[column]).encode("utf-8") if column in r else b"" for r in page]
+                    chunks[column] = write_column_chunk(f, values)
+
+                table_entry["row_groups"].append({"rows": len(page), "chunks": chunks})
+                counts[table_key] += len(page)
+
+            directory["tables"][table_key] = table_entry
+
+        directory_bytes = json.dumps(directory).encode("utf-8")
+        f.write(directory_bytes)
+        f.write(struct.pack("<Q", len(directory_bytes)))
+        f.write(MAGIC)
+
+    return counts
+
+def open_snapshot(path):
+    '''Opens a snapshot file with mmap. Takes a path and returns a snapshot dictionary. Raises ValueError if the file isn't a valid snapshot'''
+    with open(path, "rb") as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if len(mapped) < 24 or mapped[:8] != MAGIC or mapped[-8:] != MAGIC:
+        raise ValueError(f"{path} is not a snapshot file.")
+
+    (directory_length,) = struct.unpack_from("<Q", mapped, len(mapped) - 16)
+    directory_start = len(mapped) - 16 - directory_length
+    directory = json.loads(mapped[directory_start:len(mapped) - 16].decode("utf-8"))
+
+    if directory.get("version") != VERSION:
+        raise ValueError(f"Unsupported snapshot version: {directory.get('version')}")
+
+    return {"path": path, "mmap": mapped, "tables": directory["tables"]}
+
+def read_column_chunk(snapshot, chunk_offset, rows):
+    '''Yields the decoded values of one column chunk. Missing fields are yielded as the MISSING marker'''
+    mapped = snapshot["mmap"]
+    offsets = struct.unpack_from(f"<{rows + 1}I", mapped, chunk_offset)
+    data_start = chunk_offset + 4 * (rows + 1)
+
+    for i in range(rows):
+        start = data_start + offsets[i]
+        end = data_start + offsets[i + 1]
+        if start == end:
+            yield MISSING
+        else:
+            yield json.loads(mapped[start:end].decode("utf-8"))
+
+def find_snapshot_table(snapshot, table_ref):
+    '''Finds a table in a snapshot by table key or table ID. Returns the table entry or None'''
+    for table_key, table in snapshot["tables"].items():
+        if table_ref.upper() == table_key or table_ref == table["table_id"]:
+            return table
+    return None
+
+def snapshot_records(snapshot, table_ref):
+    '''Returns all records for a table in a snapshot. Takes the snapshot and a table key or ID. Raises ValueError if the table wasn't exported'''
+    table = find_snapshot_table(snapshot, table_ref)
+    if table is None:
+        raise ValueError(f"Table {table_ref} is not in snapshot {snapshot['path']}.")
+
+    records = []
+    for row_group in table["row_groups"]:
+        rows = [{} for _ in range(row_group["rows"])]
+        for column in table["columns"]:
+            if column not in row_group["chunks"]:
+                continue
+            values = read_column_chunk(snapshot, row_group["chunks"][column], row_group["rows"])
+            for row, value in zip(rows, values):
+                if value is not MISSING:
+                    row[column] = value
+        records.extend(rows)
+
+    return records
+
+def snapshot_column(snapshot, table_ref, column):
+    '''Returns every value of a single column without decoding the rest of the table. Missing fields come back as None'''
+    table = find_snapshot_table(snapshot, table_ref)
+    if table is None:
+        raise ValueError(f"Table {table_ref} is not in snapshot {snapshot['path']}.")
+
+    values = []
+    for row_group in table["row_groups"]:
+        if column not in row_group["chunks"]:
+            values.extend([None] * row_group["rows"])
+            continue
+        for value in read_column_chunk(snapshot, row_group["chunks"][column], row_group["rows"]):
+            values.append(None if value is MISSING else value)
+    return values
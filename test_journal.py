@@ -0,0 +1,102 @@
+import json
+
+from journal import append_journal, coalesce_journal, flush_journal, read_journal, requeue_rejected
+
+
+def queue(path, table, record_id, payload):
+    append_journal(path, {"op": "patch", "table": table, "id": record_id, "payload": payload})
+
+
+def test_coalesce_keeps_last_value_per_field():
+    '''Edits to the same record merge into one payload, with later edits to a field winning'''
+    entries = [
+        {"op": "patch", "table": "BOOKS", "id": 1, "payload": {"Status": "reading"}},
+        {"op": "patch", "table": "BOOKS", "id": 2, "payload": {"Rating": 4}},
+        {"op": "patch", "table": "BOOKS", "id": 1, "payload": {"Status": "read", "Owned": 1}},
+        {"op": "patch", "table": "AUTHORS", "id": 1, "payload": {"Notes": "x"}},
+    ]
+
+    assert coalesce_journal(entries) == {
+        "BOOKS": [{"Id": 1, "Status": "read", "Owned": 1}, {"Id": 2, "Rating": 4}],
+        "AUTHORS": [{"Id": 1, "Notes": "x"}],
+    }
+
+
+def test_flush_sends_one_batch_per_table(tmp_path):
+    '''A successful flush sends each table once, empties the journal and reports the flushed records'''
+    path = str(tmp_path / "journal.jsonl")
+    queue(path, "BOOKS", 1, {"Status": "reading"})
+    queue(path, "BOOKS", 1, {"Status": "read"})
+    queue(path, "AUTHORS", 7, {"Notes": "x"})
+    sent = []
+    flushed = []
+
+    def send_batch(table_key, payloads):
+        sent.append((table_key, payloads))
+        return [{"Id": p["Id"]} for p in payloads]
+
+    written = flush_journal(path, send_batch, lambda table_key, response, payloads: flushed.append(table_key))
+
+    assert written == 2
+    assert sent == [("BOOKS", [{"Id": 1, "Status": "read"}]), ("AUTHORS", [{"Id": 7, "Notes": "x"}])]
+    assert flushed == ["BOOKS", "AUTHORS"]
+    assert read_journal(path) == []
+
+
+def test_partial_failure_keeps_only_unsent_entries(tmp_path):
+    '''When one table's batch fails, only that table's entries stay queued'''
+    path = str(tmp_path / "journal.jsonl")
+    queue(path, "BOOKS", 1, {"Status": "read"})
+    queue(path, "AUTHORS", 7, {"Notes": "x"})
+    queue(path, "AUTHORS", 7, {"Website": "y"})
+
+    def send_batch(table_key, payloads):
+        if table_key == "AUTHORS":
+            raise RuntimeError("PATCH failed: 503")
+        return payloads
+
+    assert flush_journal(path, send_batch) == 1
+    assert read_journal(path) == [
+        {"op": "patch", "table": "AUTHORS", "id": 7, "payload": {"Notes": "x"}},
+        {"op": "patch", "table": "AUTHORS", "id": 7, "payload": {"Website": "y"}},
+    ]
+
+
+def test_rejected_batch_is_split_and_bad_records_moved_aside(tmp_path):
+    '''A rejected batch is resent record by record. Only the invalid record lands in the rejected file'''
+    path = str(tmp_path / "journal.jsonl")
+    queue(path, "BOOKS", 1, {"Status": "read"})
+    queue(path, "BOOKS", 2, {"Colour": "blue"})
+    queue(path, "BOOKS", 3, {"Rating": 5})
+    sent = []
+
+    def send_batch(table_key, payloads):
+        if any("Colour" in p for p in payloads):
+            raise ValueError("PATCH failed: 400 - unknown field Colour")
+        sent.extend(payloads)
+        return payloads
+
+    assert flush_journal(path, send_batch) == 2
+    assert sent == [{"Id": 1, "Status": "read"}, {"Id": 3, "Rating": 5}]
+    assert read_journal(path) == []
+
+    with open(path + ".rejected", encoding="utf-8") as f:
+        rejected = [json.loads(line) for line in f]
+    assert rejected == [{"op": "patch", "table": "BOOKS", "id": 2, "payload": {"Colour": "blue"},
+                         "error": "PATCH failed: 400 - unknown field Colour"}]
+
+
+def test_requeue_rejected_moves_entries_back(tmp_path):
+    '''Rejected patches go back into the journal without their error and the rejected file is removed'''
+    path = str(tmp_path / "journal.jsonl")
+    queue(path, "BOOKS", 1, {"Status": "read"})
+    with open(path + ".rejected", "w", encoding="utf-8") as f:
+        f.write(json.dumps({"op": "patch", "table": "BOOKS", "id": 2, "payload": {"Rating": 5}, "error": "400"}) + "\n")
+
+    assert requeue_rejected(path) == 1
+    assert read_journal(path) == [
+        {"op": "patch", "table": "BOOKS", "id": 1, "payload": {"Status": "read"}},
+        {"op": "patch", "table": "BOOKS", "id": 2, "payload": {"Rating": 5}},
+    ]
+    assert read_journal(path + ".rejected") == []
+    assert requeue_rejected(path) == 0
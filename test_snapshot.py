@@ -0,0 +1,53 @@
+import pytest
+
+from snapshot import open_snapshot, write_snapshot, snapshot_records, snapshot_column
+
+
+def test_round_trip_keeps_records(tmp_path):
+    '''Records written to a snapshot come back unchanged, including nulls, nested values and unicode'''
+    path = str(tmp_path / "library.snap")
+    pages = [
+        [{"Id": 1, "Title": "Orlando", "Tags": None, "Books": {"Id": 3}},
+         {"Id": 2, "Title": "Ça", "Tags": "gothic,horror"}],
+        [{"Id": 3, "Title": "Beloved", "Author(s)": ["Toni Morrison"]}],
+    ]
+
+    counts = write_snapshot(path, [("BOOKS", "mth1bd75romp8p3", iter(pages))])
+    snapshot = open_snapshot(path)
+
+    assert counts == {"BOOKS": 3}
+    assert snapshot_records(snapshot, "mth1bd75romp8p3") == pages[0] + pages[1]
+    assert snapshot_records(snapshot, "books") == pages[0] + pages[1]
+
+
+def test_column_missing_from_earlier_row_group(tmp_path):
+    '''A column first seen in a later page reads as absent in earlier records, not as null'''
+    path = str(tmp_path / "library.snap")
+    pages = [[{"Id": 1}, {"Id": 2}], [{"Id": 3, "Notes": None}, {"Id": 4, "Notes": "signed"}]]
+
+    write_snapshot(path, [("AUTHORS", "mgd51sp0b93cu0y", iter(pages))])
+    snapshot = open_snapshot(path)
+
+    assert snapshot_records(snapshot, "AUTHORS") == [{"Id": 1}, {"Id": 2}, {"Id": 3, "Notes": None}, {"Id": 4, "Notes": "signed"}]
+    assert snapshot_column(snapshot, "AUTHORS", "Notes") == [None, None, None, "signed"]
+
+
+def test_empty_and_missing_tables(tmp_path):
+    '''An exported empty table has no records, and a table that wasn't exported raises ValueError'''
+    path = str(tmp_path / "library.snap")
+
+    write_snapshot(path, [("REVIEWS", "mjr2am3o9mlpyo1", iter([[]]))])
+    snapshot = open_snapshot(path)
+
+    assert snapshot_records(snapshot, "REVIEWS") == []
+    with pytest.raises(ValueError):
+        snapshot_records(snapshot, "BOOKS")
+
+
+def test_open_rejects_other_files(tmp_path):
+    '''Opening a file that isn't a snapshot raises ValueError'''
+    path = tmp_path / "notes.txt"
+    path.write_bytes(b"not a snapshot file at all, just some text")
+
+    with pytest.raises(ValueError):
+        open_snapshot(str(path))